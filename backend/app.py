@@ -1,21 +1,37 @@
+from functools import lru_cache
 from flask_graphql import GraphQLView
-import graphene
 from flask_cors import CORS
-from schema import Mutation, Query
-from utils import app, db
+from ratelimit import RateLimiter
+from responses import Compression, json_encode
+from schema import CachingBackend, get_schema
+from utils import app, cors_origins, db, ReplicaRoutingMiddleware
 
-CORS(app)
-schema = graphene.Schema(query=Query, mutation=Mutation)
+# Credentials are allowed for the read-your-writes cookie (see `utils.remember_writes`), from the front-end only
+CORS(app, origins=cors_origins, supports_credentials=True)
+RateLimiter(app)
+Compression(app)
 
-# Basic GraphQL set-up
-app.add_url_rule(
-    '/graphql',
-    view_func=GraphQLView.as_view(
+
+@lru_cache(maxsize=None)
+def graphql_view():
+    """
+    The view of the GraphQL end-point, built along with the schema when the first request comes in:
+    importing `app` stays cheap, and gunicorn workers each build their own after being forked.
+    """
+    return GraphQLView.as_view(
         'graphql',
-        schema=schema,
-        graphiql=True
+        schema=get_schema(),
+        backend=CachingBackend(),
+        encode=json_encode,
+        middleware=[ReplicaRoutingMiddleware()],
+        graphiql=True,
+        # Accept a list of operations in a single POST, answered with a list of results
+        batch=True
     )
-)
+
+
+# Basic GraphQL set-up
+app.add_url_rule('/graphql', 'graphql', view_func=lambda: graphql_view()(), methods=GraphQLView.methods)
 
 port = 4293
 @app.route('/')
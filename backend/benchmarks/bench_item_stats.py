@@ -0,0 +1,100 @@
+import os
+import random
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+"""
+Compares serving item statistics from the `item_daily_stats` rollup with computing
+them with an ad-hoc GROUP BY over the transactions table.
+
+Usage, from `backend/`: python benchmarks/bench_item_stats.py [number of transactions]
+
+The benchmark runs against $DATABASE_URI, or a temporary SQLite database by default.
+Its tables are dropped and recreated: never point it at real data!
+"""
+if "DATABASE_URI" not in os.environ:
+    os.environ["DATABASE_URI"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+
+sys.path.insert(0, os.getcwd())
+from sqlalchemy import case, func
+import rollups
+import schema
+from tables import Item, Transaction
+from utils import db
+
+item_count = 200
+days = 365
+repeat = 20
+
+
+def populate(transaction_count):
+    db.drop_all()
+    db.create_all()
+    db.session.bulk_insert_mappings(Item, [
+        {"id": i, "name": f"item {i}", "quantity": 10} for i in range(1, item_count + 1)
+    ])
+
+    start = datetime.now() - timedelta(days=days)
+    transactions = []
+    for _ in range(transaction_count):
+        requested = start + timedelta(seconds=random.randrange(days * 86400))
+        accepted = requested + timedelta(hours=random.randrange(1, 48))
+        transactions.append({
+            "item_id": random.randint(1, item_count),
+            "requested_quantity": 1,
+            "accepted": True,
+            "returned": True,
+            "date_requested": requested,
+            "date_accepted": accepted,
+            "date_returned": accepted + timedelta(hours=random.randrange(1, 24 * 14)),
+        })
+    db.session.bulk_insert_mappings(Transaction, transactions)
+    db.session.commit()
+
+
+def loan_seconds():
+    if db.engine.dialect.name == "sqlite":
+        return (func.julianday(Transaction.date_returned) - func.julianday(Transaction.date_accepted)) * 86400
+    return func.timestampdiff(db.text("SECOND"), Transaction.date_accepted, Transaction.date_returned)
+
+
+def ad_hoc_stats():
+    """
+    The same statistics as `itemStats`, computed from the transactions.
+    """
+    closed = Transaction.returned == True
+    return db.session.query(
+        Transaction.item_id,
+        func.count(Transaction.id),
+        func.sum(case([(Transaction.date_accepted != None, 1)], else_=0)),
+        func.avg(loan_seconds())
+    ).filter(closed).group_by(Transaction.item_id).all()
+
+
+def rollup_stats():
+    return schema.Query.resolve_item_stats(None, None, "admin", "token")
+
+
+def measure(name, function):
+    seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+    print(f"{name:<24}{seconds * 1000:>10.2f} ms")
+    db.session.rollback()
+
+
+if __name__ == '__main__':
+    transaction_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    # Authentication is out of the scope of this benchmark
+    schema.auth_level = lambda email, auth_token: 2
+
+    print(f"{transaction_count} transactions on {item_count} items over {days} days ({db.engine.url.drivername})")
+    populate(transaction_count)
+
+    start = timeit.default_timer()
+    rollups.roll_up(rollups.lock_watermark())
+    db.session.commit()
+    print(f"{'initial rollup':<24}{(timeit.default_timer() - start) * 1000:>10.2f} ms")
+
+    measure("ad-hoc GROUP BY", ad_hoc_stats)
+    measure("rollup read", rollup_stats)
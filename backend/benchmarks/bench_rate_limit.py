@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+import timeit
+
+"""
+Measures the overhead the rate limiter adds to each request made to the GraphQL end-point,
+with buckets kept in memory and in a SQLite file.
+
+Usage, from `backend/`: python benchmarks/bench_rate_limit.py
+"""
+sys.path.insert(0, os.getcwd())
+from flask import Flask, request
+from ratelimit import RateLimiter
+
+number = 20000
+query = '{ allItems { edges { node { id, name, dateIn, dateOut, quantity } } } }'
+mutation = 'mutation{ showTransactions(email: "potato@mail.com", authToken: "%s"){ transactions { id } } }' % ("t" * 1500)
+
+
+def measure(name, store, body):
+    app = Flask(__name__)
+    app.config.update(RATE_LIMIT_QUERIES="1000000/1000000", RATE_LIMIT_MUTATIONS="1000000/1000000",
+                      RATE_LIMIT_STORE=store)
+    app.add_url_rule('/graphql', 'graphql', lambda: '{}', methods=['POST'])
+    limiter = RateLimiter(app)
+
+    def limit():
+        # Parse the body again every time, as it would be for a new request
+        request.__dict__.pop('_cached_json', None)
+        limiter.limit()
+
+    with app.test_request_context('/graphql', method='POST', json=body):
+        seconds = min(timeit.repeat(limit, number=number, repeat=5)) / number
+    print(f"{name:<32}{seconds * 1e6:>8.1f} µs")
+
+
+if __name__ == '__main__':
+    store = os.path.join(tempfile.mkdtemp(), "buckets.db")
+    measure("memory, anonymous query", None, {'query': query})
+    measure("memory, mutation with token", None, {'query': mutation})
+    measure("memory, batch of 3", None, [{'query': query}, {'query': mutation}, {'query': mutation}])
+    measure("sqlite, anonymous query", store, {'query': query})
+    measure("sqlite, mutation with token", store, {'query': mutation})
@@ -0,0 +1,90 @@
+import gzip
+import os
+import sys
+import timeit
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+"""
+Compares encoding `allItems` responses of 1k, 10k and 100k items:
+- before: datetimes converted to strings field by field (`graphene.DateTime`), then encoded with `json`
+- after: datetimes handed over as is to `responses.json_encode`, with `json` or orjson
+along with the size of the response, and the cost of compressing it.
+
+Usage, from `backend/`: python benchmarks/bench_responses.py
+"""
+sys.path.insert(0, os.getcwd())
+import graphene
+from graphql_server import json_encode as default_json_encode
+import responses
+
+repeat = 5
+
+
+def all_items(count):
+    """
+    Result of an `allItems` query on `count` items, as graphql-core builds it.
+    """
+    start = datetime(2019, 1, 1, 9, 30, 12, 345678)
+    edges = [
+        OrderedDict([('node', OrderedDict([
+            ('id', f"SXRlbU9iamVjdDo{i}"),
+            ('name', f"Arduino Uno #{i}"),
+            ('dateIn', start + timedelta(minutes=i)),
+            ('dateOut', start + timedelta(minutes=2 * i)),
+            ('quantity', i % 7),
+        ]))])
+        for i in range(count)
+    ]
+    return {'data': OrderedDict([('allItems', OrderedDict([('edges', edges)]))])}
+
+
+def before(result):
+    for edge in result['data']['allItems']['edges']:
+        node = edge['node']
+        node['dateIn'] = graphene.DateTime.serialize(node['dateIn'])
+        node['dateOut'] = graphene.DateTime.serialize(node['dateOut'])
+    return default_json_encode(result)
+
+
+def measure(function, make_argument):
+    """
+    Best time of `function` over a few runs, in milliseconds, and its last result.
+    Its argument is made anew before each run, untimed.
+    """
+    best = None
+    for _ in range(repeat):
+        argument = make_argument()
+        start = timeit.default_timer()
+        result = function(argument)
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, result
+
+
+def json_fallback_encode(result):
+    orjson, responses.orjson = responses.orjson, None
+    try:
+        return responses.json_encode(result)
+    finally:
+        responses.orjson = orjson
+
+
+if __name__ == '__main__':
+    print(f"encoder: {'orjson' if responses.orjson else 'json'}, "
+          f"compression: {'brotli and gzip' if responses.brotli else 'gzip'}")
+    for count in (1000, 10000, 100000):
+        before_ms, encoded = measure(before, lambda: all_items(count))
+        fallback_ms, _ = measure(json_fallback_encode, lambda: all_items(count))
+        after_ms, _ = measure(responses.json_encode, lambda: all_items(count))
+        encoded = encoded.encode()
+        gzip_ms, gzipped = measure(lambda data: gzip.compress(data, 5), lambda: encoded)
+
+        print(f"{count} items, {len(encoded) / 1024:.0f} KiB")
+        print(f"  encoding before   {before_ms:>9.2f} ms")
+        print(f"  encoding, json    {fallback_ms:>9.2f} ms")
+        print(f"  encoding, orjson  {after_ms:>9.2f} ms")
+        print(f"  gzip              {gzip_ms:>9.2f} ms, {len(gzipped) / 1024:.0f} KiB")
+        if responses.brotli:
+            brotli_ms, compressed = measure(lambda data: responses.brotli.compress(data, quality=4), lambda: encoded)
+            print(f"  brotli            {brotli_ms:>9.2f} ms, {len(compressed) / 1024:.0f} KiB")
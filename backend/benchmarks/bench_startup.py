@@ -0,0 +1,58 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Measures the cold start of the back-end: importing the app, then the latency of the first
+GraphQL requests served by a fresh process, compared with the same requests once warm.
+
+Usage, from `backend/`: python benchmarks/bench_startup.py [number of fresh processes]
+
+The benchmark runs against $DATABASE_URI, or a temporary SQLite database by default.
+"""
+query = '{ allItems { edges { node { id, name, dateIn, dateOut, quantity } } } }'
+
+
+def measure_process():
+    """
+    Runs in a fresh process, and prints its measurements as JSON.
+    """
+    timings = {}
+    start = time.perf_counter()
+    sys.path.insert(0, os.getcwd())
+    from app import app
+    from graphql.utils.introspection_query import introspection_query
+    from utils import db
+    timings["import app"] = time.perf_counter() - start
+
+    db.create_all()
+    db.session.remove()
+    client = app.test_client()
+    for name, body in (("allItems", {'query': query}), ("introspection", {'query': introspection_query})):
+        for run in ("first", "second"):
+            start = time.perf_counter()
+            response = client.post('/graphql', json=body)
+            timings[f"{name}, {run}"] = time.perf_counter() - start
+            assert response.status_code == 200, response.data
+    print(json.dumps(timings))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["--process"]:
+        measure_process()
+        sys.exit()
+
+    env = dict(os.environ, RATE_LIMIT_QUERIES="1000/1000", PYTHONWARNINGS="ignore")
+    env.setdefault("DATABASE_URI", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    runs = [
+        json.loads(subprocess.check_output([sys.executable, __file__, "--process"], env=env))
+        for _ in range(processes)
+    ]
+    for name in runs[0]:
+        timings = sorted(run[name] for run in runs)
+        print(f"{name:<24}{timings[len(timings) // 2] * 1000:>10.2f} ms (median)")
@@ -0,0 +1,118 @@
+from sqlalchemy import create_engine
+import sys
+
+from utils import app
+
+"""
+Online migration from the name/email primary keys to integer surrogate keys.
+
+The migration runs in two phases, so the site keeps serving while most of it happens:
+
+- `expand`: adds the new integer columns next to the old string ones and backfills
+  them in small batches. It is safe to run (and re-run) while the old version
+  of the back-end is still serving traffic.
+- `contract`: catches up on rows written since `expand`, swaps the primary and
+  foreign keys over to the integer columns and drops the old string columns.
+  The old back-end must not write during this phase, as rows it inserts would have
+  no integer keys: stop it (or switch it to read-only) first, then deploy the version
+  of the back-end using the new keys right after.
+"""
+usage = "Usage: python migrate_surrogate_keys.py expand|contract"
+engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+
+batch_size = 1000
+online = "ALGORITHM=INPLACE, LOCK=NONE"
+
+
+def run_batches(conn, statement):
+    """
+    Repeats an `UPDATE ... LIMIT` statement until it no longer touches any row,
+    so that no single statement holds row locks on the whole table.
+    """
+    while conn.execute(statement % batch_size).rowcount:
+        pass
+
+
+def foreign_keys(conn, table, column):
+    """
+    Names of the foreign key constraints defined on `table.column`.
+    """
+    return [row[0] for row in conn.execute(
+        "SELECT CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s "
+        "AND REFERENCED_TABLE_NAME IS NOT NULL", (table, column))]
+
+
+def has_column(conn, table, column):
+    return conn.execute(
+        "SELECT COUNT(*) FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+        (table, column)).scalar() == 1
+
+
+def backfill(conn):
+    """
+    Numbers admins and items in order of their old key, then points the
+    foreign key columns at the new numbers. Only rows still missing a value are touched.
+    """
+    for table, key in (("admins", "email"), ("items", "name")):
+        conn.execute(f"SET @next_id := (SELECT COALESCE(MAX(id), 0) FROM {table})")
+        run_batches(conn, f"UPDATE {table} SET id = (@next_id := @next_id + 1) "
+                          f"WHERE id IS NULL ORDER BY {key} LIMIT %i")
+
+    run_batches(conn, "UPDATE items SET created_by_id = "
+                      "(SELECT id FROM admins WHERE admins.email = items.created_by) "
+                      "WHERE created_by_id IS NULL AND created_by IN "
+                      "(SELECT email FROM admins WHERE id IS NOT NULL) LIMIT %i")
+    run_batches(conn, "UPDATE transactions SET item_id = "
+                      "(SELECT id FROM items WHERE items.name = transactions.item) "
+                      "WHERE item_id IS NULL AND item IN "
+                      "(SELECT name FROM items WHERE id IS NOT NULL) LIMIT %i")
+
+
+def expand(conn):
+    if not has_column(conn, "admins", "id"):
+        conn.execute(f"ALTER TABLE admins ADD COLUMN id INT NULL, {online}")
+    if not has_column(conn, "items", "id"):
+        conn.execute(f"ALTER TABLE items ADD COLUMN id INT NULL, "
+                     f"ADD COLUMN created_by_id INT NULL, {online}")
+    if not has_column(conn, "transactions", "item_id"):
+        conn.execute(f"ALTER TABLE transactions ADD COLUMN item_id INT NULL, {online}")
+    backfill(conn)
+
+
+def contract(conn):
+    backfill(conn)
+
+    # The old foreign keys reference the primary keys about to be dropped
+    for table, column in (("items", "created_by"), ("transactions", "item")):
+        for constraint in foreign_keys(conn, table, column):
+            conn.execute(f"ALTER TABLE {table} DROP FOREIGN KEY {constraint}")
+
+    # AUTO_INCREMENT is added along with the new primary key, so inserts never lack an id.
+    # MySQL copies the tables to do so, blocking writes for the time it takes.
+    conn.execute("ALTER TABLE admins MODIFY id INT NOT NULL AUTO_INCREMENT, DROP PRIMARY KEY, ADD PRIMARY KEY (id), "
+                 "ADD UNIQUE INDEX ix_admins_email (email)")
+    conn.execute("ALTER TABLE items MODIFY id INT NOT NULL AUTO_INCREMENT, DROP PRIMARY KEY, ADD PRIMARY KEY (id), "
+                 "ADD UNIQUE INDEX ix_items_name (name)")
+
+    conn.execute("ALTER TABLE items ADD CONSTRAINT items_created_by_id_fk "
+                 "FOREIGN KEY (created_by_id) REFERENCES admins (id)")
+    conn.execute("ALTER TABLE transactions ADD INDEX ix_transactions_item_id (item_id), "
+                 "ADD CONSTRAINT transactions_item_id_fk FOREIGN KEY (item_id) REFERENCES items (id)")
+
+    # Last catch-up, so that no link is lost with the old columns
+    backfill(conn)
+    conn.execute(f"ALTER TABLE items DROP COLUMN created_by, {online}")
+    conn.execute(f"ALTER TABLE transactions DROP COLUMN item, {online}")
+
+
+if __name__ == '__main__':
+    phases = {"expand": expand, "contract": contract}
+    if len(sys.argv) != 2 or sys.argv[1] not in phases:
+        print(usage)
+        sys.exit(1)
+
+    conn = engine.connect()
+    phases[sys.argv[1]](conn)
+    conn.close()
@@ -0,0 +1,283 @@
+from collections import OrderedDict
+from flask import Response, request
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+
+"""
+Token-bucket rate limiting of the GraphQL end-point.
+
+Each client gets two buckets, one for queries and one for mutations. Every operation
+takes a token from the matching bucket, and buckets refill continuously at a fixed rate
+up to their capacity (the burst size). A request needing more tokens than available is
+refused with a 429 status and a Retry-After header, before any authentication or database work,
+and without taking any token. Requests holding more operations than a bucket can ever hold are refused with a 400 status.
+
+Each IP address has buckets shared by all its clients, a few times larger than those of
+a single client, as many users may share an address (e.g. behind the campus NAT). Clients sending
+an authentication token also get buckets of their own, keyed by a hash of the token, so that one
+of them can't use up the budget of a whole address. As tokens are not verified yet at this point,
+sending a new token with every request only gives new buckets of the second kind.
+
+Behind reverse proxies, the address of clients is only known if the proxies are trusted, see `utils`.
+"""
+auth_token_pattern = re.compile(r'authToken\s*:\s*"([^"]+)"')
+# Tokens of a GraphQL document telling what its operations are: strings and comments are matched
+# so that they can be skipped, and brackets so that only top-level keywords and names are considered
+document_tokens = re.compile(r'''
+    "{3}[^"\\]*(?:(?:\\.|"(?!""))[^"\\]*)*"{3}
+  | "[^"\\\n\r]*(?:\\.[^"\\\n\r]*)*"
+  | \#[^\n\r]*
+  | ([{}()])
+  | \b(query|mutation|subscription|fragment)\b[\s,]*([_A-Za-z]\w*)?
+''', re.VERBOSE)
+# Tokens sent by the front-end when nobody is logged in
+anonymous_tokens = {"null", "undefined"}
+
+
+def take(bucket, now, rate, burst, cost):
+    """
+    Takes `cost` tokens from a bucket, given as a (tokens, last update) pair, or None for a new bucket.
+    Returns the updated bucket, and how many seconds to wait before retrying if there were not enough tokens.
+    """
+    tokens, updated = bucket if bucket else (burst, now)
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens < cost:
+        return (tokens, now), (cost - tokens) / rate
+    return (tokens - cost, now), 0
+
+
+class MemoryBucketStore(object):
+    """
+    Buckets kept in the memory of the current process.
+
+    Buckets left untouched for `max_idle` seconds are full again, and forgotten.
+    Past `max_buckets` buckets, the least recently used ones are forgotten anyway.
+    """
+    def __init__(self, max_idle, max_buckets=100000):
+        self.max_idle = max_idle
+        self.max_buckets = max_buckets
+        # Buckets by key, least recently updated first
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, buckets, now):
+        """
+        Takes tokens from each of the `buckets`, given as (key, rate, burst, cost) tuples, if they all have enough.
+        Otherwise, takes none and returns how many seconds to wait before retrying.
+        """
+        with self.lock:
+            taken = [(key, take(self.buckets.get(key), now, rate, burst, cost)) for key, rate, burst, cost in buckets]
+            retry_after = max(wait for _, (_, wait) in taken)
+            if not retry_after:
+                for key, (bucket, _) in taken:
+                    self.buckets[key] = bucket
+                    self.buckets.move_to_end(key)
+            self.forget(now)
+        return retry_after
+
+    def forget(self, now):
+        while self.buckets:
+            key, (_, updated) = next(iter(self.buckets.items()))
+            if updated > now - self.max_idle and len(self.buckets) <= self.max_buckets:
+                break
+            del self.buckets[key]
+
+
+class SQLiteBucketStore(object):
+    """
+    Buckets kept in a local SQLite file, shared by all the worker processes of a server.
+    Buckets left untouched for `max_idle` seconds are full again, and deleted every so often.
+    """
+    # Number of takes between deletions of idle buckets, in each process
+    cleanup_interval = 1000
+
+    def __init__(self, path, max_idle):
+        self.path = path
+        self.max_idle = max_idle
+        self.takes = 0
+        self.local = threading.local()
+
+    def connection(self):
+        """
+        Connection of the current thread, opened on first use. Processes forked
+        after that (e.g. by gunicorn with --preload) open their own.
+        """
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            self.local.connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+            )
+            self.local.connection.execute("CREATE INDEX IF NOT EXISTS ix_buckets_updated ON buckets (updated)")
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def take(self, buckets, now):
+        """
+        See `MemoryBucketStore.take`.
+        """
+        connection = self.connection()
+        self.takes += 1
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            taken = []
+            for key, rate, burst, cost in buckets:
+                bucket = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                taken.append((key, take(bucket, now, rate, burst, cost)))
+            retry_after = max(wait for _, (_, wait) in taken)
+            if not retry_after:
+                connection.executemany("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                                       [(key,) + bucket for key, (bucket, _) in taken])
+            if self.takes % self.cleanup_interval == 0:
+                connection.execute("DELETE FROM buckets WHERE updated < ?", (now - self.max_idle,))
+        finally:
+            connection.execute("COMMIT")
+        return retry_after
+
+
+class RateLimiter(object):
+    """
+    Flask extension rate limiting the requests made to the `graphql` end-point.
+
+    Configuration:
+    RATE_LIMIT_QUERIES: Rate of queries per second, and burst size of a client, e.g. "5/20"
+    RATE_LIMIT_MUTATIONS: Rate of mutations per second, and burst size of a client, e.g. "1/10"
+    RATE_LIMIT_STORE: Optional path of a SQLite file sharing the buckets between processes
+    RATE_LIMIT_CLIENTS_PER_IP: How many clients' budgets all the clients of an IP address share, e.g. 10
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATE_LIMIT_QUERIES', "5/20")
+        app.config.setdefault('RATE_LIMIT_MUTATIONS', "1/10")
+        app.config.setdefault('RATE_LIMIT_STORE', None)
+        app.config.setdefault('RATE_LIMIT_CLIENTS_PER_IP', 10)
+        self.clients_per_ip = float(app.config['RATE_LIMIT_CLIENTS_PER_IP'])
+        self.queries = parse_limit(app.config['RATE_LIMIT_QUERIES'])
+        self.mutations = parse_limit(app.config['RATE_LIMIT_MUTATIONS'])
+        # Time an empty bucket takes to fill up again, whatever its scale
+        max_idle = max(burst / rate for rate, burst in (self.queries, self.mutations))
+        store_path = app.config['RATE_LIMIT_STORE']
+        self.store = SQLiteBucketStore(store_path, max_idle) if store_path else MemoryBucketStore(max_idle)
+        app.extensions['rate_limiter'] = self
+        app.before_request(self.limit)
+
+    def limit(self):
+        # CORS preflight requests don't run any operation
+        if request.endpoint != 'graphql' or request.method == 'OPTIONS':
+            return None
+
+        operations = request_operations()
+        mutations = sum(1 for document, operation_name in operations if is_mutation(document, operation_name))
+        queries = len(operations) - mutations
+        # Batches larger than a client's burst could never go through, retrying them is pointless
+        if mutations > self.mutations[1] or queries > self.queries[1]:
+            return error_response("Too many operations in a single request.", 400)
+
+        # Clients take from their own buckets if they have any, and from those shared by their IP address
+        identities = [("shared:" + str(request.remote_addr), self.clients_per_ip)]
+        token_key = client_key(operations)
+        if token_key:
+            identities.insert(0, (token_key, 1))
+        buckets = []
+        for identity, scale in identities:
+            if mutations:
+                rate, burst = self.mutations
+                buckets.append((f"mutations:{identity}", rate * scale, burst * scale, mutations))
+            if queries:
+                rate, burst = self.queries
+                buckets.append((f"queries:{identity}", rate * scale, burst * scale, queries))
+        retry_after = self.store.take(buckets, time.time())
+        if not retry_after:
+            return None
+        return error_response("Too many requests, please try again later.", 429,
+                              headers={'Retry-After': str(math.ceil(retry_after))})
+
+
+def error_response(message, status, headers=None):
+    return Response(
+        json.dumps({'errors': [{'message': message}]}),
+        status=status,
+        headers=headers,
+        content_type='application/json'
+    )
+
+
+def parse_limit(limit):
+    """
+    Parses a "rate/burst" limit into a (rate, burst) pair of floats.
+    """
+    rate, burst = limit.split("/")
+    return float(rate), float(burst)
+
+
+def request_operations():
+    """
+    GraphQL operations sent in the current request, which may be a batch,
+    as (document, operation name) pairs.
+    """
+    if request.mimetype == 'application/json':
+        data = request.get_json(silent=True)
+        entries = data if isinstance(data, list) else [data]
+        return [(entry.get('query'), entry.get('operationName')) for entry in entries
+                if isinstance(entry, dict)] or [(None, None)]
+    if request.mimetype == 'application/graphql':
+        return [(request.get_data(as_text=True), request.args.get('operationName'))]
+    return [(request.values.get('query'), request.values.get('operationName'))]
+
+
+def is_mutation(document, operation_name=None):
+    """
+    Whether the operation a GraphQL document runs is a mutation, given the name of the operation
+    to run when the document holds several of them.
+
+    Only the top level of the document is scanned: this is much faster than parsing it with graphql-core,
+    which matters as the front-end inlines long authentication tokens in its documents.
+    Invalid documents may be counted either way, as they fail before running anything.
+    """
+    if not isinstance(document, str):
+        return False
+    braces = parentheses = 0
+    # Type and name of the definition at the top level, once its keyword or selection set is found
+    definition = None
+    for match in document_tokens.finditer(document):
+        bracket, keyword, name = match.groups()
+        if keyword and not braces and not parentheses:
+            definition = (keyword, name)
+        elif bracket == '(':
+            parentheses += 1
+        elif bracket == ')':
+            parentheses -= 1
+        elif bracket == '{' and not parentheses:
+            if not braces and definition is None:
+                # Shorthand for an anonymous query
+                definition = ('query', None)
+            braces += 1
+        elif bracket == '}' and not parentheses:
+            braces -= 1
+            if not braces:
+                operation, definition_name = definition or (None, None)
+                if operation != 'fragment' and operation_name in (None, definition_name):
+                    return operation == 'mutation'
+                definition = None
+    return False
+
+
+def client_key(operations):
+    """
+    Identifies the client making the current request by its authentication token,
+    or returns None when it sends none. See module documentation.
+    """
+    for document, _ in operations:
+        for auth_token in auth_token_pattern.findall(document or ""):
+            if auth_token not in anonymous_tokens:
+                return "token:" + hashlib.sha1(auth_token.encode()).hexdigest()
+    return None
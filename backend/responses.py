@@ -0,0 +1,79 @@
+from datetime import date
+from flask import request
+import gzip
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+Encoding of the responses of the GraphQL end-point.
+
+GraphQL results are encoded with orjson when it is installed, and the standard `json` module otherwise.
+Large responses are compressed with brotli (when installed) or gzip, depending on what the client accepts.
+"""
+
+
+def encode_datetime(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def json_encode(data, pretty=False):
+    """
+    Encodes GraphQL results, which may contain datetimes, as JSON.
+    """
+    if orjson and pretty:
+        # Pretty results are rendered within GraphiQL's page, which needs text
+        return orjson.dumps(data, default=encode_datetime, option=orjson.OPT_INDENT_2).decode()
+    if orjson:
+        return orjson.dumps(data, default=encode_datetime)
+    if pretty:
+        return json.dumps(data, indent=2, sort_keys=True, default=encode_datetime)
+    return json.dumps(data, separators=(',', ':'), default=encode_datetime)
+
+
+class Compression(object):
+    """
+    Flask extension compressing the JSON responses larger than a threshold,
+    when the client accepts it.
+
+    Configuration:
+    COMPRESSION_MIN_SIZE: Size in bytes from which responses are compressed
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESSION_MIN_SIZE', 1400)
+        self.min_size = int(app.config['COMPRESSION_MIN_SIZE'])
+        app.extensions['compression'] = self
+        app.after_request(self.compress)
+
+    def compress(self, response):
+        if (response.mimetype != 'application/json' or response.direct_passthrough
+                or 'Content-Encoding' in response.headers):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+
+        accepted = request.accept_encodings
+        if brotli and accepted['br']:
+            response.set_data(brotli.compress(data, quality=4))
+            response.headers['Content-Encoding'] = 'br'
+        elif accepted['gzip']:
+            response.set_data(gzip.compress(data, compresslevel=5))
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
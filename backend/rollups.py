@@ -0,0 +1,110 @@
+from collections import defaultdict
+from sqlalchemy import bindparam, inspect
+from tables import ItemDailyStats, RollupWatermark, Transaction
+
+from utils import db
+
+"""
+Incremental maintenance of the `item_daily_stats` rollup.
+
+Closed (returned) transactions are rolled up exactly once. When they are, they are given
+consecutive close sequence numbers, in order of return, and the last number given is kept as
+a watermark. Sequence numbers rather than return dates tell which transactions are rolled up,
+as several transactions may be returned within the same second.
+
+Running this script rolls up any transaction not yet included, e.g. to fill the
+rollup from the existing transaction history. It first adds the `close_sequence`
+column to databases created without it, so it must run before deploying a back-end using it.
+"""
+watermark_name = 'item_daily_stats'
+
+
+def lock_watermark():
+    """
+    Locks the watermark of the rollup until the end of the database transaction.
+
+    Transactions must be closed while holding this lock, so that concurrent updates
+    never number the same transactions.
+    """
+    watermark = RollupWatermark.query.filter_by(name=watermark_name).with_for_update().first()
+    if not watermark:
+        watermark = RollupWatermark(name=watermark_name, value=0)
+        db.session.add(watermark)
+    return watermark
+
+
+def roll_up(watermark):
+    """
+    Adds the closed transactions not numbered yet to the rollup,
+    then moves the (locked) `watermark` to the last number given to them.
+    """
+    transactions = db.session.query(
+        Transaction.id, Transaction.item_id, Transaction.date_requested,
+        Transaction.date_accepted, Transaction.date_returned
+    ).filter(Transaction.returned == True, Transaction.date_returned != None, Transaction.close_sequence == None)
+
+    # Changes to the rollup, per item and day: requests, checkouts, returns, loans and loan seconds
+    changes = defaultdict(lambda: [0, 0, 0, 0, 0.0])
+    numbers = []
+    ordered = transactions.order_by(Transaction.date_returned, Transaction.id)
+    for transaction_id, item_id, date_requested, date_accepted, date_returned in ordered:
+        watermark.value += 1
+        numbers.append({'transaction_id': transaction_id, 'close_sequence': watermark.value})
+        # The item was deleted since
+        if item_id is None:
+            continue
+
+        if date_requested:
+            changes[(item_id, date_requested.date())][0] += 1
+        if date_accepted:
+            changes[(item_id, date_accepted.date())][1] += 1
+        returned = changes[(item_id, date_returned.date())]
+        returned[2] += 1
+        if date_accepted:
+            returned[3] += 1
+            returned[4] += (date_returned - date_accepted).total_seconds()
+
+    if numbers:
+        db.session.execute(
+            Transaction.__table__.update()
+            .where(Transaction.id == bindparam('transaction_id'))
+            .values(close_sequence=bindparam('close_sequence')),
+            numbers
+        )
+    if not changes:
+        return
+
+    days = [day for _, day in changes]
+    existing = ItemDailyStats.query.filter(
+        ItemDailyStats.item_id.in_({item_id for item_id, _ in changes}),
+        ItemDailyStats.day.between(min(days), max(days))
+    )
+    rows = {(row.item_id, row.day): row for row in existing}
+    for key, (requests, checkouts, returns, loans, loan_seconds) in changes.items():
+        row = rows.get(key)
+        if not row:
+            row = ItemDailyStats(item_id=key[0], day=key[1], requests=0, checkouts=0,
+                                 returns=0, loans=0, loan_seconds=0)
+            db.session.add(row)
+        row.requests += requests
+        row.checkouts += checkouts
+        row.returns += returns
+        row.loans += loans
+        row.loan_seconds += loan_seconds
+
+
+def add_close_sequence():
+    """
+    Adds the `close_sequence` column to the transactions of databases created without it.
+    """
+    if 'close_sequence' in [column['name'] for column in inspect(db.engine).get_columns('transactions')]:
+        return
+    with db.engine.begin() as conn:
+        conn.execute("ALTER TABLE transactions ADD COLUMN close_sequence INTEGER")
+        conn.execute("CREATE INDEX ix_transactions_close_sequence ON transactions (close_sequence)")
+
+
+if __name__ == '__main__':
+    add_close_sequence()
+    roll_up(lock_watermark())
+    db.session.commit()
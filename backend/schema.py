@@ -1,27 +1,71 @@
 import base64
-from datetime import datetime
+from datetime import datetime, timedelta
+from flask import g, has_request_context
+from functools import lru_cache, partial, wraps
 import graphene
+from graphql import parse, validate
+from graphql.backend import GraphQLBackend, GraphQLDocument
+from graphql.execution import execute, ExecutionResult
+from graphql.language import ast
+from graphql.language.visitor import BREAK, Visitor, visit
 from graphql_relay.node.node import from_global_id
 from graphene_sqlalchemy import SQLAlchemyObjectType, SQLAlchemyConnectionField
+import hashlib
 import json
 import os
 import requests
-from tables import Item, Transaction, Admin
+import threading
+from rollups import lock_watermark, roll_up
+from sqlalchemy import func
+from tables import Item, ItemDailyStats, Transaction, Admin
 
-from utils import db, supersecretpassword
+from utils import db, supersecretpassword, ExpiringStore, idempotency_ttl, idempotency_max_keys, idempotency_wait
 
 
 err_auth_admin = "You must be an authenticated administrator!"
 err_auth = "You must log in to perform this action."
+err_in_progress = "A request with this idempotency key is still in progress, please try again later."
+err_key_reused = "This idempotency key was already used with different arguments."
+
+# Results of the mutations performed with an idempotency key, see `idempotent`
+idempotency_store = ExpiringStore(max_size=idempotency_max_keys, ttl=idempotency_ttl)
+
+
+class DateTime(graphene.DateTime):
+    """
+    `DateTime` scalar handing datetimes over to the JSON encoder as they are,
+    which serializes them much faster than converting each of them to a string here.
+    Used for all datetime columns, as graphene-sqlalchemy maps them to `graphene.DateTime`.
+    """
+    @staticmethod
+    def serialize(dt):
+        return dt
 
 
 class ItemObject(SQLAlchemyObjectType):
     """
     Maps to `Item` table in Database.
+    `createdBy` is kept as the creating administrator's email.
     """
     class Meta:
         model = Item
         interfaces = (graphene.relay.Node, )
+        # Internal keys, the creator is exposed as `createdBy`
+        exclude_fields = ('created_by_id', )
+
+    date_in = DateTime()
+    date_out = DateTime()
+    created_by = graphene.String()
+
+    def resolve_created_by(self, _):
+        return self.creator.email if self.creator else None
+
+    @classmethod
+    def get_node(cls, info, id):
+        # Global IDs issued before items had integer keys encode the item's name
+        if not id.isdigit():
+            return cls.get_query(info).filter_by(name=id).first()
+        return super(ItemObject, cls).get_node(info, id)
 
 
 class AdminObject(SQLAlchemyObjectType):
@@ -32,14 +76,98 @@ class AdminObject(SQLAlchemyObjectType):
         model = Admin
         interfaces = (graphene.relay.Node, )
 
+    date_created = DateTime()
+
+    @classmethod
+    def get_node(cls, info, id):
+        # Global IDs issued before admins had integer keys encode the admin's email
+        if not id.isdigit():
+            return cls.get_query(info).filter_by(email=id).first()
+        return super(AdminObject, cls).get_node(info, id)
+
 
 class TransactionObject(SQLAlchemyObjectType):
     """
     Maps to `Transaction` table in Database.
+    `item` is kept as the name of the item, as the front-end displays it directly.
     """
     class Meta:
         model = Transaction
         interfaces = (graphene.relay.Node, )
+        # Internal keys, the item is exposed as `item`
+        exclude_fields = ('item_id', 'close_sequence')
+
+    date_requested = DateTime()
+    date_accepted = DateTime()
+    date_returned = DateTime()
+    item = graphene.String()
+
+    def resolve_item(self, _):
+        return self.item.name if self.item else None
+
+
+def idempotent(mutate):
+    """
+    Lets clients safely retry a mutation by passing the same `idempotency_key`:
+    repeated requests get the result of the first successful one back, without the mutation running again.
+    A retry arriving while the first request is still running waits for it to finish.
+
+    Keys are scoped to the mutation, user and authentication token. Reusing a key with different arguments
+    is an error, rather than replaying an unrelated result. Results are remembered
+    as the IDs of the objects they list, which are reloaded from the database when a key is repeated:
+    the objects are the same as in the original result, but their fields show their current values.
+
+    Keys are remembered by each server process: a retry served by another worker process runs the mutation again.
+    """
+    @wraps(mutate)
+    def mutate_once(root, info, idempotency_key=None, **kwargs):
+        if idempotency_key is None:
+            return mutate(root, info, **kwargs)
+
+        email = kwargs.get('email', kwargs.get('admin_email'))
+        key = (mutate.__qualname__, email, kwargs.get('auth_token'), idempotency_key)
+        arguments = hashlib.sha1(json.dumps(kwargs, sort_keys=True, default=str).encode()).hexdigest()
+        # Claim the key with an in-flight marker, unless another request holds it already
+        in_flight = threading.Event()
+        stored = idempotency_store.setdefault(key, in_flight)
+        while stored is not in_flight:
+            if not isinstance(stored, threading.Event):
+                stored_arguments, result_type, fields = stored
+                if stored_arguments != arguments:
+                    raise Exception(err_key_reused)
+                return result_type(**{name: load_by_ids(*field) for name, field in fields.items()})
+            if not stored.wait(idempotency_wait):
+                raise Exception(err_in_progress)
+            # The first request failed, and dropped its marker
+            stored = idempotency_store.setdefault(key, in_flight)
+
+        try:
+            result = mutate(root, info, **kwargs)
+            db.session.commit()
+            fields = {}
+            for name in type(result)._meta.fields:
+                objects = getattr(result, name) or []
+                model = type(objects[0]) if objects else None
+                fields[name] = (model, [obj.id for obj in objects])
+            idempotency_store.set(key, (arguments, type(result), fields))
+        except Exception:
+            idempotency_store.delete(key)
+            raise
+        finally:
+            in_flight.set()
+        return result
+
+    return mutate_once
+
+
+def load_by_ids(model, ids):
+    """
+    Loads the rows of `model` with the given IDs, in the same order.
+    """
+    if not ids:
+        return []
+    rows = {row.id: row for row in model.query.filter(model.id.in_(ids))}
+    return [rows[id] for id in ids if id in rows]
 
 
 class CreateItem(graphene.Mutation):
@@ -52,15 +180,18 @@ class CreateItem(graphene.Mutation):
     name: Name of item.
     quantity: Quantity of item available
     auth_token: Authentication token
+    idempotency_key: Optional unique key, making retries of the same request safe
     """
     class Arguments:
         email = graphene.String(required=True)
         item_name = graphene.String(required=True)
         quantity = graphene.Int(required=True)
         auth_token = graphene.String(required=True)
+        idempotency_key = graphene.String(required=False)
 
     items = graphene.List(ItemObject)
 
+    @idempotent
     def mutate(self, _, email, item_name, quantity, auth_token):
         item = Item.query.filter_by(name=item_name).first()
         # Check if the item already exists
@@ -68,7 +199,8 @@ class CreateItem(graphene.Mutation):
             raise Exception("Already found one of this item...")
             
         validate_authentication(email, auth_token, admin=True)
-        item = Item(name=item_name, quantity=quantity, date_in=datetime.now(), created_by=email)
+        creator = Admin.query.filter_by(email=email).first()
+        item = Item(name=item_name, quantity=quantity, date_in=datetime.now(), creator=creator)
         db.session.add(item)
         db.session.commit()
         items = Item.query.all()
@@ -99,8 +231,9 @@ class DeleteItem(graphene.Mutation):
 
         validate_authentication(email, auth_token, admin=True)
 
-        # Delete the item
+        # Delete the item, along with its usage statistics
         for item in items:
+            ItemDailyStats.query.filter_by(item_id=item.id).delete()
             db.session.delete(item)
         db.session.commit()
         items = Item.query.all()
@@ -144,6 +277,7 @@ class ReserveItem(graphene.Mutation):
     auth_token: Token used to authenticate
     quantity: Quantity of the item requested
     item_name: Name of the item requested from the inventory
+    idempotency_key: Optional unique key, making retries of the same request safe
     """
     class Arguments:
         email = graphene.String()
@@ -151,9 +285,11 @@ class ReserveItem(graphene.Mutation):
         auth_token = graphene.String(required=False)
         quantity = graphene.Int(required=True)
         item_name = graphene.String(required=True)
+        idempotency_key = graphene.String(required=False)
 
     items = graphene.List(ItemObject)
 
+    @idempotent
     def mutate(self, _, email, student_id, auth_token, quantity, item_name):
         # Verify that the quantity the user wishes to check out is valid
         if quantity < 0:
@@ -178,7 +314,7 @@ class ReserveItem(graphene.Mutation):
             user_requested_id=student_id,
             user_requested_email=email,
             requested_quantity=quantity,
-            item=item.name,
+            item=item,
             date_requested=datetime.now(),
             accepted=False
         )
@@ -198,15 +334,18 @@ class CheckOutItem(graphene.Mutation):
     item: Name of the item being requested.
     admin_email: Email of the administrator accepting a checkout request
     auth_token: Authentication token associated to the administrator user.
+    idempotency_key: Optional unique key, making retries of the same request safe
     """
     class Arguments:
         transaction_id = graphene.String(required=True)
         admin_email = graphene.String(required=True)
         item = graphene.String(required=True)
         auth_token = graphene.String(required=True)
+        idempotency_key = graphene.String(required=False)
 
     transactions = graphene.List(TransactionObject)
 
+    @idempotent
     def mutate(self, _, transaction_id, item, admin_email, auth_token):
         _, transaction_id = from_global_id(transaction_id)
 
@@ -243,26 +382,36 @@ class CheckInItem(graphene.Mutation):
     transaction_id: ID of the transaction that took place to reserve the item
     admin_email: The name of the administrator checking the item back in
     auth_token: Authentication token associated with the administrator user
+    idempotency_key: Optional unique key, making retries of the same request safe
     """
     class Arguments:
         item = graphene.String(required=True)
         transaction_id = graphene.String(required=True)
         admin_email = graphene.String(required=True)
         auth_token = graphene.String(required=True)
+        idempotency_key = graphene.String(required=False)
 
     transactions = graphene.List(TransactionObject)
 
+    @idempotent
     def mutate(self, _, item, transaction_id, admin_email, auth_token):
         validate_authentication(admin_email, auth_token, admin=True)
 
-        # Check the item back in
+        # The transaction is closed under the rollup's lock, then added to the usage statistics.
+        # It is read again under the lock, as a concurrent check-in may have closed it already.
+        watermark = lock_watermark()
         _, transaction_id = from_global_id(transaction_id)
-        transaction = Transaction.query.filter_by(id=transaction_id).first()
+        transaction = Transaction.query.filter_by(id=transaction_id).populate_existing().with_for_update().first()
+        if transaction.returned:
+            raise Exception("This item was already checked in.")
+
+        # Check the item back in
         item = Item.query.filter_by(name=item).first()
         transaction.returned = True
         transaction.date_returned = datetime.now()
         item.date_in = datetime.now()
         item.quantity += transaction.requested_quantity
+        roll_up(watermark)
         transactions = Transaction.query.all()
 
         return CheckInItem(transactions)
@@ -330,12 +479,76 @@ class Mutation(graphene.ObjectType):
     create_admin = CreateAdmin.Field()
 
 
+class ItemStatsObject(graphene.ObjectType):
+    """
+    Usage statistics of an item, served from the `item_daily_stats` rollup.
+    Only closed (returned) transactions are accounted for.
+    """
+    item_name = graphene.String()
+    week_start = graphene.Date(description="Monday of the week, when statistics are split by week")
+    requests = graphene.Int()
+    checkouts = graphene.Int()
+    returns = graphene.Int()
+    average_loan_duration = graphene.Float(description="Average duration of a loan, in seconds")
+
+
 class Query(graphene.ObjectType):
     """
     Defines all available queries (Read).
     """
     node = graphene.relay.Node.Field()
     all_items = SQLAlchemyConnectionField(ItemObject)
+    item_stats = graphene.List(
+        ItemStatsObject,
+        email=graphene.String(required=True),
+        auth_token=graphene.String(required=True),
+        since=graphene.Date(),
+        until=graphene.Date(),
+        by_week=graphene.Boolean(default_value=False)
+    )
+
+    def resolve_item_stats(self, _, email, auth_token, since=None, until=None, by_week=False):
+        """
+        Usage statistics of every item between `since` and `until` (inclusive), most requested first.
+        Reserved for administrators.
+        """
+        validate_authentication(email, auth_token, admin=True)
+
+        grouping = [ItemDailyStats.item_id] + ([ItemDailyStats.day] if by_week else [])
+        query = db.session.query(
+            *grouping,
+            func.sum(ItemDailyStats.requests),
+            func.sum(ItemDailyStats.checkouts),
+            func.sum(ItemDailyStats.returns),
+            func.sum(ItemDailyStats.loans),
+            func.sum(ItemDailyStats.loan_seconds)
+        ).group_by(*grouping)
+        if since:
+            query = query.filter(ItemDailyStats.day >= since)
+        if until:
+            query = query.filter(ItemDailyStats.day <= until)
+
+        # Daily rows are folded into weeks here, as date functions differ between databases
+        totals = {}
+        for row in query:
+            week_start = row[1] - timedelta(days=row[1].weekday()) if by_week else None
+            total = totals.setdefault((row[0], week_start), [0, 0, 0, 0, 0])
+            for i, value in enumerate(row[len(grouping):]):
+                total[i] += value or 0
+
+        names = dict(db.session.query(Item.id, Item.name).filter(Item.id.in_({key[0] for key in totals})))
+        stats = [
+            ItemStatsObject(
+                item_name=names.get(item_id),
+                week_start=week_start,
+                requests=requests,
+                checkouts=checkouts,
+                returns=returns,
+                average_loan_duration=loan_seconds / loans if loans else None
+            )
+            for (item_id, week_start), (requests, checkouts, returns, loans, loan_seconds) in totals.items()
+        ]
+        return sorted(stats, key=lambda stat: (-stat.requests, stat.item_name or "", stat.week_start))
 
 
 def validate_authentication(email, auth_token, admin=False):
@@ -360,6 +573,22 @@ def auth_level(email, auth_token):
     then the user is considered authenticated.
 
     If the user is part of the administrator database, the user is given more rights.
+
+    Levels are cached for the duration of an HTTP request, so that all the operations
+    of a batched request share a single authentication.
+    """
+    if not has_request_context():
+        return fetch_auth_level(email, auth_token)
+
+    auth_levels = g.setdefault('auth_levels', {})
+    if (email, auth_token) not in auth_levels:
+        auth_levels[(email, auth_token)] = fetch_auth_level(email, auth_token)
+    return auth_levels[(email, auth_token)]
+
+
+def fetch_auth_level(email, auth_token):
+    """
+    Computes the authentication level of a user, see `auth_level`.
     """
     authentication_response = requests.get(
         'https://graph.microsoft.com/v1.0/me/',
@@ -377,4 +606,94 @@ def auth_level(email, auth_token):
 
     return 1
 
-schema = graphene.Schema(query=Query, mutation=Mutation)
\ No newline at end of file
+
+@lru_cache(maxsize=None)
+def get_schema():
+    """
+    The GraphQL schema, built on first use and then shared by the whole application.
+    """
+    return graphene.Schema(query=Query, mutation=Mutation)
+
+
+class CachingBackend(GraphQLBackend):
+    """
+    GraphQL backend parsing and validating each distinct document only once.
+    The results of introspection queries, which only depend on the schema, are cached as well.
+
+    Only introspection documents and documents without inlined argument values are kept: the others are
+    rarely sent twice, as the front-end inlines authentication tokens in them, which must not linger in memory.
+    """
+    def __init__(self, max_documents=1000):
+        self.documents = ExpiringStore(max_size=max_documents, ttl=24 * 3600)
+
+    def document_from_string(self, schema, document_string):
+        document = self.documents.get((schema, document_string))
+        if document is None:
+            document = self.build_document(schema, document_string)
+            if is_introspection(document.document_ast) or not has_inlined_arguments(document.document_ast):
+                self.documents.set((schema, document_string), document)
+        return document
+
+    def build_document(self, schema, document_string):
+        document_ast = parse(document_string)
+        validation_errors = validate(schema, document_ast)
+        if validation_errors:
+            def run(**_):
+                return ExecutionResult(errors=validation_errors, invalid=True)
+        elif is_introspection(document_ast):
+            run = cache_results(partial(execute, schema, document_ast))
+        else:
+            run = partial(execute, schema, document_ast)
+        return GraphQLDocument(schema, document_string, document_ast, run)
+
+
+def is_introspection(document_ast):
+    """
+    Whether a document only selects introspection fields (`__schema`, `__type` and `__typename`).
+    """
+    operations = [definition for definition in document_ast.definitions
+                  if isinstance(definition, ast.OperationDefinition)]
+    return all(
+        isinstance(selection, ast.Field) and selection.name.value.startswith("__")
+        for operation in operations
+        for selection in operation.selection_set.selections
+    )
+
+
+class InlinedArgumentsFinder(Visitor):
+    def __init__(self):
+        self.found = False
+
+    def enter_Argument(self, node, *_):
+        if not isinstance(node.value, ast.Variable):
+            self.found = True
+            return BREAK
+
+
+def has_inlined_arguments(document_ast):
+    """
+    Whether a document passes any argument value as a literal, rather than as a variable.
+    """
+    finder = InlinedArgumentsFinder()
+    visit(document_ast, finder)
+    return finder.found
+
+
+def cache_results(run):
+    """
+    Caches the successful results of a document executed without variables, per operation.
+    """
+    results = {}
+
+    def run_cached(**kwargs):
+        if kwargs.get('variable_values'):
+            return run(**kwargs)
+        operation_name = kwargs.get('operation_name')
+        if operation_name not in results:
+            result = run(**kwargs)
+            if result.errors:
+                return result
+            results[operation_name] = result
+        return results[operation_name]
+
+    return run_cached
@@ -4,13 +4,14 @@ from utils import db
 class Item(db.Model):
     __tablename__ = 'items'
 
-    name = db.Column(db.String(256), primary_key=True)
-    created_by = db.Column(db.String(256), db.ForeignKey('admins.email'))
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(256), unique=True, index=True, nullable=False)
+    created_by_id = db.Column(db.Integer, db.ForeignKey('admins.id'))
     date_in = db.Column(db.DateTime)
     date_out = db.Column(db.DateTime)
     quantity = db.Column(db.Integer)
 
-    transactions = db.relationship("Transaction", backref="items", lazy=True)
+    transactions = db.relationship("Transaction", backref="item", lazy=True)
 
     def __repr__(self):
         return '<Item %r>' % self.name
@@ -19,11 +20,12 @@ class Item(db.Model):
 class Admin(db.Model):
     __tablename__ = 'admins'
 
-    email = db.Column(db.String(256), primary_key=True)
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(256), unique=True, index=True, nullable=False)
     name = db.Column(db.String(256))
     date_created = db.Column(db.DateTime)
 
-    items = db.relationship("Item", backref="admins", lazy=True)
+    items = db.relationship("Item", backref="creator", lazy=True)
 
     def __repr__(self):
         return '<Admin %r>' % self.name
@@ -39,10 +41,45 @@ class Transaction(db.Model):
     requested_quantity = db.Column(db.Integer)
     accepted = db.Column(db.Boolean)
     returned = db.Column(db.Boolean)
-    item = db.Column(db.String(256), db.ForeignKey('items.name'))
+    item_id = db.Column(db.Integer, db.ForeignKey('items.id'), index=True)
     date_requested = db.Column(db.DateTime)
     date_accepted = db.Column(db.DateTime)
     date_returned = db.Column(db.DateTime)
+    # Order in which the transaction was added to the usage statistics, see `rollups.py`
+    close_sequence = db.Column(db.Integer, index=True)
 
     def __repr__(self):
         return '<Transaction %r>' % self.id
+
+
+class ItemDailyStats(db.Model):
+    """
+    Usage of an item on a given day, rolled up from its closed transactions (see `rollups.py`).
+    Each transaction counts towards the day it was requested, accepted and returned.
+    The statistics of an item are deleted along with it.
+    """
+    __tablename__ = 'item_daily_stats'
+
+    item_id = db.Column(db.Integer, db.ForeignKey('items.id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    requests = db.Column(db.Integer, default=0)
+    checkouts = db.Column(db.Integer, default=0)
+    returns = db.Column(db.Integer, default=0)
+    loans = db.Column(db.Integer, default=0)
+    loan_seconds = db.Column(db.Float, default=0)
+
+    def __repr__(self):
+        return '<ItemDailyStats %r %r>' % (self.item_id, self.day)
+
+
+class RollupWatermark(db.Model):
+    """
+    Close sequence number of the last transaction included in a rollup.
+    """
+    __tablename__ = 'rollup_watermarks'
+
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, default=0)
+
+    def __repr__(self):
+        return '<RollupWatermark %r>' % self.name
@@ -1,13 +1,22 @@
+from flask import _app_ctx_stack
 from graphene.test import Client
 import os
 import pytest
+from sqlalchemy import event, orm
 import sys
 
+# Tests run against an in-memory SQLite database, unless TEST_DATABASE_URI is set.
+# "{worker}" in TEST_DATABASE_URI is replaced by the name of the pytest-xdist worker,
+# to give each worker its own database, e.g.: TEST_DATABASE_URI=mysql:///techcabinettest_{worker}
+worker = os.environ.get("PYTEST_XDIST_WORKER", "main")
+os.environ["DATABASE_URI"] = os.environ.get("TEST_DATABASE_URI", "sqlite://").format(worker=worker)
+os.environ.pop("REPLICA_DATABASE_URIS", None)
+
 sys.path.insert(0, os.getcwd())
-from utils import db
-from schema import schema, err_auth
+from utils import db, RoutingSession
+from schema import get_schema, err_auth
 
-client = Client(schema)
+client = Client(get_schema())
 supersecret = 'secret'
 email = 'potato@mail.com'
 password = 'potato'
@@ -22,8 +31,53 @@ def clear_env():
     os.environ.update(_environ)
 
 
-@pytest.fixture()
-def clear_db():
-    db.session.commit()
+@pytest.fixture(scope='session')
+def database():
+    """
+    Creates the schema once for the whole test session.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        # pysqlite's own transaction handling breaks SAVEPOINTs, leave it to SQLAlchemy.
+        # Foreign keys are enforced, as they are by MySQL.
+        @event.listens_for(db.engine, "connect")
+        def connect(dbapi_connection, _):
+            dbapi_connection.isolation_level = None
+            dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+        @event.listens_for(db.engine, "begin")
+        def begin(connection):
+            connection.execute("BEGIN")
+
     db.drop_all()
     db.create_all()
+    return db
+
+
+@pytest.fixture(autouse=True)
+def isolated_db(database):
+    """
+    Runs each test in a database transaction rolled back once it is done.
+    The sessions of the application work within a SAVEPOINT of that transaction,
+    restarted whenever they commit or roll back.
+    """
+    connection = db.engine.connect()
+    transaction = connection.begin()
+
+    def restart_savepoint(session, session_transaction):
+        if session_transaction.nested and not session_transaction._parent.nested:
+            session.expire_all()
+            session.begin_nested()
+
+    def create_session():
+        session = RoutingSession(db, bind=connection, binds={})
+        session.begin_nested()
+        event.listen(session, "after_transaction_end", restart_savepoint)
+        return session
+
+    app_session = db.session
+    db.session = orm.scoped_session(create_session, scopefunc=_app_ctx_stack.__ident_func__)
+    yield
+    db.session.remove()
+    db.session = app_session
+    transaction.rollback()
+    connection.close()
@@ -99,3 +99,38 @@ mutation{
   }
 }
 '''
+
+item_node = '''
+{
+  node(id: "%s"){
+    ... on ItemObject{
+      name,
+      createdBy
+    }
+  }
+}
+'''
+
+reserve_item_idempotent = '''
+mutation{
+  reserveItem(email: "%s", studentId:"%s", itemName:"%s", quantity:%s, authToken: "token", idempotencyKey: "%s"){
+    items{
+      id,
+      name,
+      quantity
+    }
+  }
+}
+'''
+
+item_stats = '''
+{
+  itemStats(email: "%s", authToken: ""){
+    itemName,
+    requests,
+    checkouts,
+    returns,
+    averageLoanDuration
+  }
+}
+'''
@@ -0,0 +1,54 @@
+from mock import patch
+import os
+import sys
+
+from queries import query_items, show_transactions
+
+sys.path.insert(0, os.getcwd())
+from app import app
+
+client = app.test_client()
+email = "email"
+
+auth_level_query = '''
+mutation{
+  authenticationLevel(email: "%s", authToken: ""){
+    level
+  }
+}
+'''
+
+
+@patch('schema.fetch_auth_level')
+def test_batched_operations(fetch_auth_level):
+    """
+    Tests that several operations can be sent in a single request, and that
+    they share the authentication of the user.
+    """
+    fetch_auth_level.return_value = 1
+    response = client.post('/graphql', json=[
+        {'query': auth_level_query % email},
+        {'query': query_items},
+        {'query': show_transactions % email}
+    ])
+    assert response.status_code == 200
+
+    results = response.get_json()
+    assert len(results) == 3
+    assert results[0]['data']['authenticationLevel']['level'] == 1
+    assert results[1]['data']['allItems']['edges'] == []
+    assert results[2]['data']['showTransactions']['transactions'] == []
+    assert fetch_auth_level.call_count == 1
+
+
+def test_cors_origins():
+    """
+    Tests that only the front-end may call the API with the user's cookies.
+    """
+    body = {'query': query_items}
+    response = client.post('/graphql', json=body, headers={'Origin': 'http://localhost:3000'})
+    assert response.headers['Access-Control-Allow-Origin'] == 'http://localhost:3000'
+    assert response.headers['Access-Control-Allow-Credentials'] == 'true'
+
+    response = client.post('/graphql', json=body, headers={'Origin': 'https://evil.example.com'})
+    assert 'Access-Control-Allow-Origin' not in response.headers
@@ -0,0 +1,119 @@
+from flask import Flask
+import os
+import sys
+
+sys.path.insert(0, os.getcwd())
+from ratelimit import MemoryBucketStore, RateLimiter, SQLiteBucketStore, take
+
+query = '{ allItems { edges { node { name } } } }'
+mutation = 'mutation{ showTransactions(email: "%s", authToken: "%s"){ transactions { id } } }'
+
+
+def limited_app(**config):
+    app = Flask(__name__)
+    app.config.update(config)
+    app.add_url_rule('/graphql', 'graphql', lambda: '{}', methods=['GET', 'POST'])
+    RateLimiter(app)
+    return app.test_client()
+
+
+def test_token_bucket():
+    """
+    Buckets start full, and refill at a fixed rate up to their burst size.
+    """
+    bucket, retry_after = take(None, 0, rate=1, burst=2, cost=2)
+    assert bucket == (0, 0) and retry_after == 0
+
+    bucket, retry_after = take(bucket, 0.5, rate=1, burst=2, cost=1)
+    assert retry_after == 0.5
+
+    bucket, retry_after = take(bucket, 100, rate=1, burst=2, cost=1)
+    assert bucket == (1, 100) and retry_after == 0
+
+
+def test_rate_limiting(tmpdir):
+    """
+    Queries and mutations have separate budgets, shared by the clients of an IP address,
+    and tracked per authentication token as well. Budgets can be shared through a SQLite file.
+    """
+    for store in (None, str(tmpdir.join('buckets.db'))):
+        client = limited_app(RATE_LIMIT_QUERIES="0.01/1", RATE_LIMIT_MUTATIONS="0.01/1",
+                             RATE_LIMIT_CLIENTS_PER_IP=2, RATE_LIMIT_STORE=store)
+
+        # Anonymous clients share the budget of their IP address, twice that of a client
+        assert client.post('/graphql', json={'query': query}).status_code == 200
+        assert client.post('/graphql', json={'query': query}).status_code == 200
+        response = client.post('/graphql', json={'query': query})
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) == 50
+        other_address = {'REMOTE_ADDR': '10.0.0.2'}
+        assert client.post('/graphql', json={'query': query}, environ_base=other_address).status_code == 200
+
+        assert client.post('/graphql', json={'query': mutation % ("a", "token a")}).status_code == 200
+        assert client.post('/graphql', json={'query': mutation % ("a", "token a")}).status_code == 429
+        assert client.post('/graphql', json={'query': mutation % ("b", "token b")}).status_code == 200
+        assert client.post('/graphql', json={'query': mutation % ("c", "token c")}).status_code == 429
+
+
+def test_rate_limiting__rotating_tokens():
+    """
+    Sending a new authentication token with every request doesn't give a new budget:
+    all the clients of an IP address share a few times the budget of a single client.
+    """
+    client = limited_app(RATE_LIMIT_MUTATIONS="0.01/1", RATE_LIMIT_CLIENTS_PER_IP=3)
+    # Buckets of past tokens are forgotten first, never the one shared by the IP address
+    client.application.extensions['rate_limiter'].store.max_buckets = 1
+    statuses = [client.post('/graphql', json={'query': mutation % ("a", f"token {i}")}).status_code
+                for i in range(5)]
+    assert statuses == [200, 200, 200, 429, 429]
+
+
+def test_rate_limiting__operation_types():
+    """
+    Operations are charged to the query or mutation budget depending on what the document runs,
+    whatever comes before the operation.
+    """
+    client = limited_app(RATE_LIMIT_QUERIES="0.01/10", RATE_LIMIT_MUTATIONS="0.01/1")
+    commented_mutation = '# Reserves an item\n' + mutation % ("a", "token a")
+    assert client.post('/graphql', json={'query': commented_mutation}).status_code == 200
+    assert client.post('/graphql', json={'query': commented_mutation}).status_code == 429
+
+    named = 'query Items { allItems { edges { node { name } } } } ' + (mutation % ("b", "token b")).replace(
+        'mutation{', 'mutation Transactions {')
+    assert client.post('/graphql', json={'query': named, 'operationName': 'Items'}).status_code == 200
+    assert client.post('/graphql', json={'query': named, 'operationName': 'Transactions'}).status_code == 200
+    assert client.post('/graphql', json={'query': named, 'operationName': 'Transactions'}).status_code == 429
+
+
+def test_rate_limiting__refused_requests(tmpdir):
+    """
+    Refused requests take no token from any bucket, and batches larger than a bucket are refused for good.
+    """
+    for store in (MemoryBucketStore(max_idle=10), SQLiteBucketStore(str(tmpdir.join('buckets.db')), max_idle=10)):
+        assert store.take([("client", 1, 2, 1), ("shared", 1, 1, 1)], now=0) == 0
+        # Refused by the second bucket: the first one keeps its last token
+        assert store.take([("client", 1, 2, 1), ("shared", 1, 1, 1)], now=0) == 1
+        assert store.take([("client", 1, 2, 1)], now=0) == 0
+        assert store.take([("client", 1, 2, 1)], now=0) == 1
+
+    client = limited_app(RATE_LIMIT_QUERIES="5/20")
+    response = client.post('/graphql', json=[{'query': query}] * 25)
+    assert response.status_code == 400
+    assert 'Retry-After' not in response.headers
+    assert client.post('/graphql', json=[{'query': query}] * 20).status_code == 200
+
+
+def test_rate_limiting__idle_buckets(tmpdir):
+    """
+    Buckets are forgotten once they had the time to fill up again.
+    """
+    memory = MemoryBucketStore(max_idle=10)
+    sqlite = SQLiteBucketStore(str(tmpdir.join('buckets.db')), max_idle=10)
+    sqlite.cleanup_interval = 1
+    for store in (memory, sqlite):
+        store.take([("a", 1, 10, 10)], now=0)
+        store.take([("b", 1, 10, 10)], now=5)
+        store.take([("c", 1, 10, 10)], now=11)
+
+    assert list(memory.buckets) == ["b", "c"]
+    assert [key for key, in sqlite.connection().execute("SELECT key FROM buckets ORDER BY key")] == ["b", "c"]
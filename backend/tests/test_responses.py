@@ -0,0 +1,40 @@
+from datetime import datetime
+import gzip
+import json
+import os
+import sys
+
+sys.path.insert(0, os.getcwd())
+import responses
+from app import app
+
+client = app.test_client()
+query = '{ allItems { edges { node { name, dateIn } } } }'
+
+
+def test_json_encode(monkeypatch):
+    """
+    Datetimes are encoded in ISO 8601 format, with or without orjson.
+    """
+    data = {'data': {'item': {'dateIn': datetime(2019, 3, 1, 12, 30, 15, 250)}}}
+    expected = '{"data":{"item":{"dateIn":"2019-03-01T12:30:15.000250"}}}'
+    assert json.loads(responses.json_encode(data)) == json.loads(expected)
+
+    monkeypatch.setattr(responses, 'orjson', None)
+    assert responses.json_encode(data) == expected
+
+
+def test_compression(monkeypatch):
+    """
+    Responses are compressed from a given size, when the client accepts it.
+    """
+    small = client.post('/graphql', json={'query': query}, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers
+
+    monkeypatch.setattr(app.extensions['compression'], 'min_size', 0)
+    plain = client.post('/graphql', json={'query': query})
+    assert 'Content-Encoding' not in plain.headers
+
+    compressed = client.post('/graphql', json={'query': query}, headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.data) == plain.data
@@ -1,23 +1,31 @@
+from datetime import datetime
 from graphene.test import Client
+from graphql_relay.node.node import from_global_id, to_global_id
 from mock import MagicMock, patch
 import os
 import jwt
+import pytest
 import sys
+import threading
 import time
 
 from queries import query_items, create_item, delete_item, checkout_item, show_transactions, \
-                    checkin_item, create_admin, reserve_item
+                    checkin_item, create_admin, reserve_item, item_node, reserve_item_idempotent, \
+                    item_stats
 
 sys.path.insert(0, os.getcwd())
-from schema import schema, err_auth, err_auth_admin
+from tables import Item, Transaction
+from utils import db
+from schema import get_schema, err_auth, err_auth_admin, err_key_reused, idempotent, ReserveItem, CachingBackend
 
-client = Client(schema)
+client = Client(get_schema())
 item_name = "potato"
 admin_email = "admin@mail.com"
 email = "email"
+datetime_returned = datetime(2019, 3, 1, 12, 0, 0)
 
 
-def test_inventory__show_and_create_items(clear_db):
+def test_inventory__show_and_create_items():
     """
     Tests possibility to display items
     """
@@ -29,7 +37,7 @@ def test_inventory__show_and_create_items(clear_db):
 
 
 @patch('schema.auth_level')
-def test_inventory__create_item(auth_level, clear_db):
+def test_inventory__create_item(auth_level):
     """
     Tests whether it is possible to create an item
     """
@@ -56,7 +64,36 @@ def test_inventory__create_item(auth_level, clear_db):
 
 
 @patch('schema.auth_level')
-def test_inventory__delete_item(auth_level, clear_db):
+def test_inventory__item_node(auth_level):
+    """
+    Tests that items can be fetched by their global ID, including global IDs
+    issued when items were still keyed by their name
+    """
+    auth_level.return_value = 2
+    client.execute(create_admin % (admin_email, "admin", ""))
+    result = client.execute(create_item % (item_name, 1, admin_email))
+    global_id = result['data']['createItem']['items'][0]['id']
+
+    result = client.execute(item_node % global_id)
+    assert result['data']['node'] == {'name': item_name, 'createdBy': admin_email}
+
+    result = client.execute(item_node % to_global_id('ItemObject', item_name))
+    assert result['data']['node'] == {'name': item_name, 'createdBy': admin_email}
+
+
+def test_internal_keys_hidden():
+    """
+    Tests that the foreign keys and bookkeeping columns of the tables are not part of the API
+    """
+    schema = get_schema()
+    assert 'createdById' not in schema.get_type('ItemObject').fields
+    assert 'itemId' not in schema.get_type('TransactionObject').fields
+    assert 'closeSequence' not in schema.get_type('TransactionObject').fields
+    assert 'createdBy' in schema.get_type('ItemObject').fields
+
+
+@patch('schema.auth_level')
+def test_inventory__delete_item(auth_level):
     """
     Tests possibility to delete items
     """
@@ -92,12 +129,68 @@ def test_inventory__delete_item(auth_level, clear_db):
 
 
 @patch('schema.auth_level')
-def test_transactions__reserve_item(auth_level, clear_db):
+def test_transactions__reserve_item_idempotent(auth_level):
+    """
+    Tests that retrying a reservation with the same idempotency key only reserves the item once
+    """
+    auth_level.return_value = 2
+    client.execute(create_admin % (admin_email, "admin", ""))
+    client.execute(create_item % (item_name, 3, admin_email))
+
+    auth_level.return_value = 1
+    first_result = client.execute(reserve_item_idempotent % (email, "123123123", item_name, 1, "key"))
+    auth_calls = auth_level.call_count
+    retry_result = client.execute(reserve_item_idempotent % (email, "123123123", item_name, 1, "key"))
+    assert first_result['data']['reserveItem']['items'][0]['quantity'] == 2
+    assert retry_result == first_result
+    assert auth_level.call_count == auth_calls
+
+    # A different key is a different reservation
+    other_result = client.execute(reserve_item_idempotent % (email, "123123123", item_name, 1, "other key"))
+    assert other_result['data']['reserveItem']['items'][0]['quantity'] == 1
+
+    # Reusing a key for another reservation is refused
+    reused_result = client.execute(reserve_item_idempotent % (email, "123123123", item_name, 2, "key"))
+    assert err_key_reused in reused_result['errors'][0]['message']
+
+
+@patch('schema.db')
+def test_transactions__idempotent_concurrent_retry(db):
+    """
+    Tests that a retry arriving while the original request is still running waits
+    for its result, instead of running the mutation a second time
+    """
+    started, finish = threading.Event(), threading.Event()
+    calls = []
+
+    @idempotent
+    def mutate(root, info, email):
+        calls.append(email)
+        started.set()
+        finish.wait(5)
+        return ReserveItem(items=[])
+
+    results = []
+    requests = [threading.Thread(target=lambda: results.append(mutate(None, None, email=email, idempotency_key="key")))
+                for _ in range(2)]
+    requests[0].start()
+    started.wait(5)
+    requests[1].start()
+    time.sleep(0.1)
+    finish.set()
+    for request in requests:
+        request.join(5)
+
+    assert len(calls) == 1
+    assert len(results) == 2
+    assert all(isinstance(result, ReserveItem) for result in results)
+
+
+@patch('schema.auth_level')
+def test_transactions__reserve_item(auth_level):
     """
     Tests that an authenticated user can create transactions by checking
     out an item, but that a non-authenticated user can not.
-
-    This test is linked with the next four tests.
     """
     quantity = 3
 
@@ -127,8 +220,22 @@ def test_transactions__reserve_item(auth_level, clear_db):
     assert admin_result['data']['reserveItem']['items'][0]['name'] == item_name
 
 
+@pytest.fixture()
+def reservations():
+    """
+    Creates an item, reserved once by a regular user and once by an administrator.
+    """
+    with patch('schema.auth_level', return_value=2):
+        client.execute(create_admin % (admin_email, "admin", ""))
+        client.execute(create_item % (item_name, 3, admin_email))
+    with patch('schema.auth_level', return_value=1):
+        client.execute(reserve_item % (email, "123123123", item_name, 1))
+    with patch('schema.auth_level', return_value=2):
+        client.execute(reserve_item % (admin_email, "123123123", item_name, 1))
+
+
 @patch('schema.auth_level')
-def test_transactions__show_transactions(auth_level):
+def test_transactions__show_transactions(auth_level, reservations):
     """
     Tests that an authenticated user an only see their transactions,
     while an administrator can see all transactions.
@@ -150,7 +257,7 @@ def test_transactions__show_transactions(auth_level):
 
 
 @patch('schema.auth_level')
-def test_transactions__checkout_item(auth_level):
+def test_transactions__checkout_item(auth_level, reservations):
     """
     Tests that a checkout request can be accepted by an administrator but
     not by a regular user.
@@ -170,10 +277,8 @@ def test_transactions__checkout_item(auth_level):
 
 
 @patch('schema.auth_level')
-def test_transactions__checkin_item(auth_level):
+def test_transactions__checkin_item(auth_level, reservations):
     """
-    Final test in the chain of "transaction" tests.
-    
     Tests that an administrator can check items back in, but a regular
     user can not.
     """
@@ -190,3 +295,109 @@ def test_transactions__checkin_item(auth_level):
     admin_user_result = client.execute(checkin_item % (admin_email, transaction_id, item_name))
     assert admin_user_result['data']['checkInItem']['transactions'][0]['returned']
 
+
+@patch('schema.auth_level')
+def test_transactions__checkin_item_concurrently(auth_level, reservations):
+    """
+    Tests that a transaction closed by a concurrent check-in, after this request first read it,
+    is not checked in twice
+    """
+    auth_level.return_value = 1
+    regular_user_transactions = client.execute(show_transactions % (email))
+    transaction_id = regular_user_transactions['data']['showTransactions']['transactions'][0]['id']
+
+    # This request read the transaction while still open, then a concurrent check-in closed it
+    transaction = Transaction.query.get(from_global_id(transaction_id)[1])
+    assert not transaction.returned
+    db.session.execute(Transaction.__table__.update().values(returned=True))
+    quantity = Item.query.filter_by(name=item_name).one().quantity
+
+    auth_level.return_value = 2
+    result = client.execute(checkin_item % (admin_email, transaction_id, item_name))
+    assert "already checked in" in result['errors'][0]['message']
+    assert Item.query.filter_by(name=item_name).one().quantity == quantity
+
+
+@patch('schema.auth_level')
+def test_transactions__item_stats(auth_level, reservations):
+    """
+    Tests that closed transactions are accounted for in the usage statistics of items,
+    which only administrators can see.
+    """
+    auth_level.return_value = 1
+    regular_user_transactions = client.execute(show_transactions % (email))
+    transaction_id = regular_user_transactions['data']['showTransactions']['transactions'][0]['id']
+
+    auth_level.return_value = 2
+    client.execute(checkout_item % (transaction_id, admin_email, item_name))
+    client.execute(checkin_item % (admin_email, transaction_id, item_name))
+
+    auth_level.return_value = 1
+    regular_user_result = client.execute(item_stats % (email))
+    assert err_auth_admin in regular_user_result['errors'][0]['message']
+
+    auth_level.return_value = 2
+    admin_user_result = client.execute(item_stats % (admin_email))
+    stats = admin_user_result['data']['itemStats']
+    assert len(stats) == 1
+    assert stats[0]['itemName'] == item_name
+    assert stats[0]['returns'] == 1
+    assert stats[0]['checkouts'] == 1
+    assert stats[0]['averageLoanDuration'] >= 0
+
+
+@patch('schema.auth_level')
+def test_transactions__item_stats_same_second(auth_level, reservations):
+    """
+    Tests that transactions returned within the same second are all accounted for.
+    """
+    auth_level.return_value = 2
+    admin_transactions = client.execute(show_transactions % (admin_email))
+    with patch('schema.datetime') as datetime:
+        datetime.now.return_value = datetime_returned
+        for transaction in admin_transactions['data']['showTransactions']['transactions']:
+            result = client.execute(checkin_item % (admin_email, transaction['id'], item_name))
+            assert 'errors' not in result
+
+    stats = client.execute(item_stats % (admin_email))['data']['itemStats']
+    assert stats[0]['returns'] == 2
+
+
+@patch('schema.auth_level')
+def test_transactions__delete_item_with_stats(auth_level, reservations):
+    """
+    Tests that items can be deleted once they have usage statistics, which are deleted along with them.
+    """
+    auth_level.return_value = 1
+    regular_user_transactions = client.execute(show_transactions % (email))
+    transaction_id = regular_user_transactions['data']['showTransactions']['transactions'][0]['id']
+
+    auth_level.return_value = 2
+    client.execute(checkout_item % (transaction_id, admin_email, item_name))
+    client.execute(checkin_item % (admin_email, transaction_id, item_name))
+    assert len(client.execute(item_stats % (admin_email))['data']['itemStats']) == 1
+
+    result = client.execute(delete_item % (item_name, admin_email))
+    assert 'errors' not in result
+    assert result['data']['deleteItem']['items'] == []
+    assert client.execute(item_stats % (admin_email))['data']['itemStats'] == []
+
+
+def test_caching_backend():
+    """
+    Tests that parsed documents are kept, unless they inline argument values such as authentication tokens
+    """
+    backend = CachingBackend()
+    schema = get_schema()
+    introspection = '{ __type(name: "ItemObject") { name } }'
+    with_variables = '''
+    mutation($email: String!, $token: String!){
+      showTransactions(email: $email, authToken: $token){ transactions { id } }
+    }'''
+    for document_string in (query_items, introspection, with_variables, show_transactions % email):
+        assert backend.document_from_string(schema, document_string) is not None
+
+    assert backend.documents.get((schema, query_items)) is not None
+    assert backend.documents.get((schema, introspection)) is not None
+    assert backend.documents.get((schema, with_variables)) is not None
+    assert backend.documents.get((schema, show_transactions % email)) is None
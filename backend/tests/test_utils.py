@@ -1,6 +1,8 @@
+from mock import MagicMock
 import os
 import jwt
 import pytest
+from sqlalchemy import inspect
 import sys
 import time
 
@@ -32,4 +34,61 @@ def test_invalid_auth_token():
     """
     TODO: This is deprecated now that we use Microsoft OAUTH. Review if necessary, or delete.
     """
-    pass
\ No newline at end of file
+    pass
+
+def test_replica_routing(monkeypatch):
+    """
+    Queries read from a replica, unless the client wrote to the primary very recently.
+    Everything else uses the primary.
+    """
+    monkeypatch.setitem(utils.app.config, 'SQLALCHEMY_BINDS', {'replica_0': 'sqlite://'})
+    replica = utils.db.get_engine(utils.app, bind='replica_0')
+
+    with utils.app.test_request_context():
+        session = utils.db.create_scoped_session()
+        assert session.get_bind() is not replica
+
+        utils.g.read_only = True
+        assert session.get_bind() is replica
+
+        # Reads following a write in the same request use the primary
+        utils.g.wrote_to_primary = True
+        assert session.get_bind() is not replica
+        session.remove()
+
+        # The client is told to read from the primary for a while
+        response = utils.remember_writes(utils.app.response_class())
+        cookie = response.headers['Set-Cookie']
+        assert cookie.startswith(utils.read_your_writes_cookie + '=')
+
+    read_primary_until = cookie.split(';')[0].split('=')[1]
+    with utils.app.test_request_context(headers={'Cookie': f"{utils.read_your_writes_cookie}={read_primary_until}"}):
+        session = utils.db.create_scoped_session()
+        utils.g.read_only = True
+        assert session.get_bind() is not replica
+
+        monkeypatch.setattr(utils.time, 'time', lambda: float(read_primary_until) + 1)
+        assert session.get_bind() is replica
+        session.remove()
+
+
+def test_replica_routing__batch():
+    """
+    Mutations following a query in the same batch reload the rows the query read, maybe from a replica.
+    """
+    from tables import Item
+
+    item = Item(name="potato", quantity=3)
+    utils.db.session.add(item)
+    utils.db.session.commit()
+
+    middleware = utils.ReplicaRoutingMiddleware()
+    query, mutation = MagicMock(), MagicMock()
+    query.operation.operation = 'query'
+    mutation.operation.operation = 'mutation'
+    with utils.app.test_request_context():
+        middleware.resolve(lambda root, info: Item.query.all(), None, query)
+        assert 'quantity' not in inspect(item).expired_attributes
+
+        middleware.resolve(lambda root, info: None, None, mutation)
+        assert 'quantity' in inspect(item).expired_attributes
@@ -1,6 +1,13 @@
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from collections import OrderedDict
+from flask import Flask, g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+import math
 import os
+import random
+from sqlalchemy import orm
+import threading
+import time
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 
 """
@@ -12,12 +19,181 @@ app.debug = True
 
 
 # Config
-app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql:///techcabinetdata'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URI", 'mysql:///techcabinetdata')
 app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
 
+# Read replicas, as a comma-separated list of database URIs
+replica_uris = [uri for uri in os.environ.get("REPLICA_DATABASE_URIS", "").split(",") if uri]
+app.config['SQLALCHEMY_BINDS'] = {f'replica_{i}': uri for i, uri in enumerate(replica_uris)}
+# Seconds during which a client reads from the primary after writing to it
+app.config['READ_YOUR_WRITES_WINDOW'] = float(os.environ.get("READ_YOUR_WRITES_WINDOW", "5"))
+
 supersecretpassword = os.environ.get("supersecretpassword", "")
 
-db = SQLAlchemy(app)
+# Comma-separated origins of the front-end, the only sites allowed to call the API with the user's cookies
+cors_origins = os.environ.get("CORS_ORIGINS", "http://localhost:3000").split(",")
+
+# Number of reverse proxies in front of the app, trusted to tell the address of clients with X-Forwarded-For
+trusted_proxies = int(os.environ.get("TRUSTED_PROXIES", "0"))
+if trusted_proxies:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies)
+
+# Rate limiting of the GraphQL end-point, see `ratelimit.RateLimiter`
+for setting in ('RATE_LIMIT_QUERIES', 'RATE_LIMIT_MUTATIONS', 'RATE_LIMIT_STORE', 'RATE_LIMIT_CLIENTS_PER_IP'):
+    if setting in os.environ:
+        app.config[setting] = os.environ[setting]
+
+# Compression of the GraphQL responses, see `responses.Compression`
+if "COMPRESSION_MIN_SIZE" in os.environ:
+    app.config['COMPRESSION_MIN_SIZE'] = int(os.environ["COMPRESSION_MIN_SIZE"])
+
+# Lifetime and maximum number of idempotency keys remembered for mutations
+idempotency_ttl = int(os.environ.get("IDEMPOTENCY_TTL", "600"))
+idempotency_max_keys = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", "10000"))
+# Seconds a retried mutation waits for the original request, still in progress, to finish
+idempotency_wait = float(os.environ.get("IDEMPOTENCY_WAIT", "30"))
+
+# Cookie telling until when a client reads from the primary, after writing to it
+read_your_writes_cookie = 'read_primary_until'
+
+
+def reads_from_replica():
+    """
+    Whether the reads of the current request may be served by a read replica:
+    the request must be a GraphQL query, from a client that has not written to
+    the primary within the read-your-writes window.
+
+    Writes are remembered with a cookie (see `remember_writes`), so the window applies
+    to each user's browser, whichever worker process serves their next requests.
+    """
+    if not has_request_context() or not g.get('read_only', False) or g.get('wrote_to_primary', False):
+        return False
+    try:
+        read_primary_until = float(request.cookies.get(read_your_writes_cookie, 0))
+    except ValueError:
+        read_primary_until = 0
+    return time.time() > read_primary_until
+
+
+def remember_writes(response):
+    """
+    Sends the read-your-writes cookie to clients whose request wrote to the primary.
+    """
+    if g.get('wrote_to_primary', False):
+        window = app.config['READ_YOUR_WRITES_WINDOW']
+        response.set_cookie(read_your_writes_cookie, str(time.time() + window), max_age=math.ceil(window),
+                            httponly=True, samesite='Lax')
+    return response
+
+
+app.after_request(remember_writes)
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session sending the reads of GraphQL queries to a random read replica.
+    Everything else, including all writes, goes to the primary database.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing:
+            if has_request_context():
+                g.wrote_to_primary = True
+        elif reads_from_replica():
+            replicas = [bind for bind in self.app.config['SQLALCHEMY_BINDS'] if bind.startswith('replica_')]
+            if replicas:
+                return db.get_engine(self.app, bind=random.choice(replicas))
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Engines are created on first use, and again in each process forked after that
+    (e.g. by gunicorn with --preload), as connection pools can't be shared between processes.
+    """
+    def __init__(self, *args, **kwargs):
+        self.engines_pid = os.getpid()
+        # Engines of the parent process, kept so their connections are never closed from this one
+        self.inherited_engines = []
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_engine(self, app=None, bind=None):
+        state = get_state(self.get_app(app))
+        if self.engines_pid != os.getpid():
+            self.inherited_engines.append(state.connectors)
+            state.connectors = {}
+            self.engines_pid = os.getpid()
+        return SQLAlchemy.get_engine(self, app, bind)
+
+
+class ReplicaRoutingMiddleware(object):
+    """
+    GraphQL middleware flagging queries as read-only, so `RoutingSession`
+    can send them to the read replicas. Mutations always use the primary.
+
+    The operations of a batch share the same session: when a mutation follows a query,
+    the rows the query loaded (maybe from a replica) are expired, so the mutation reloads them from the primary.
+    """
+    def resolve(self, next, root, info, **args):
+        if root is None:
+            read_only = info.operation.operation == 'query'
+            if g.get('read_only', False) and not read_only:
+                db.session.expire_all()
+            g.read_only = read_only
+        return next(root, info, **args)
+
+
+class ExpiringStore(object):
+    """
+    Thread-safe mapping whose entries expire `ttl` seconds after being set.
+    Once `max_size` entries are stored, the oldest ones are evicted first.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            expiry, value = entry
+            if expiry < time.time():
+                del self.entries[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self._set(key, value)
+
+    def setdefault(self, key, value):
+        """
+        Returns the value stored for `key`, after atomically storing `value` if there was none.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] >= time.time():
+                return entry[1]
+            self._set(key, value)
+            return value
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def _set(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + self.ttl, value)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+db = RoutingSQLAlchemy(app)
 
 token_expiry =  int(os.environ.get("TOKEN_EXPIRY", "180"))
@@ -21,7 +21,9 @@ import './App.css';
 // The app will not run unless the baseURL points to where the Python back-end is running.
 const axiosGraphQL = axios.create({
   baseURL: 'http://localhost:4293/graphql',
-  headers: {}
+  headers: {},
+  // Sends the cookie making users read their own writes right after a mutation
+  withCredentials: true
 });
 
 const msalRequestScope = {
@@ -115,13 +117,15 @@ class App extends Component {
 
   /**
    * Mutation because I had a hard time figuring out how to return different things for different auth levels with a query
-   * Retrieves all transactions depending on the authentication level of the user (verified on the back-end)
+   * Builds the query retrieving all transactions depending on the authentication level of the user (verified on the back-end)
+   * @param {string} email: Email of the user
+   * @param {string} authToken: Authentication token of the user
    */
-  getAllTransactions(){
-    const GET_TRANSACTIONS = `
+  transactionsQuery(email, authToken){
+    return `
     mutation{
-    showTransactions(email: "${this.state.email}",
-                     authToken: "${this.state.authToken}"){
+    showTransactions(email: "${email}",
+                     authToken: "${authToken}"){
       transactions{
         id,
         accepted,
@@ -137,19 +141,6 @@ class App extends Component {
     }
   }
   `;
-
-  axiosGraphQL
-    .post('', { query: GET_TRANSACTIONS })
-    .then(
-      results => {
-        this.setState({
-          transactions: results.data.data.showTransactions.transactions
-        })
-      },
-      error => {
-        console.log(error);
-        this.setState({errors: "Couldn't load all transactions."})
-      });
   }
 
   /**
@@ -389,22 +380,24 @@ class App extends Component {
         }
       }
     `
+    // The authentication level and the transactions are fetched in a single batched request
     axiosGraphQL
-    .post('', { query: AUTH_LEVEL })
+    .post('', [{ query: AUTH_LEVEL }, { query: this.transactionsQuery(email, authToken) }])
     .then(
       results => {
-        if (results.data.data){
+        const [authResults, transactionResults] = results.data;
+        if (authResults.data){
           this.setState({
             authToken: authToken,
             email: email,
             name: name,
-            authLevel: results.data.data.authenticationLevel.level,
+            authLevel: authResults.data.authenticationLevel.level,
+            transactions: transactionResults.data ? transactionResults.data.showTransactions.transactions : [],
             loading: false
           });
-          this.getAllTransactions();
         } else {
-          if (results.data.errors && results.data.errors.length > 0){
-            this.setState({errors: `Error updating login information. ${results.data.errors[0].message}`});
+          if (authResults.errors && authResults.errors.length > 0){
+            this.setState({errors: `Error updating login information. ${authResults.errors[0].message}`});
           } else {
             this.setState({errors: `Error updating login information.`});
           }